@@ -20,16 +20,16 @@ import numpy as np
 import torch
 import torchaudio
 import random
-import librosa
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append("{}/third_party/Matcha-TTS".format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import CosyVoice, CosyVoice2
-from cosyvoice.utils.file_utils import load_wav, logging
+from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.common import set_all_random_seed
 
-from funasr import AutoModel
-
 # Load available languages
 i18n.load_path.append("./locales/")
 i18n.set("file_format", "json")
@@ -39,36 +39,55 @@ i18n.set("filename_format", "{locale}.{format}")
 inference_mode_list = []
 instruct_dict = {}
 stream_mode_list = []
+sft_mode = zero_shot_mode = cross_lingual_mode = instruct_mode = None
+inference_dict = {}
+sft_spk_modes = set()
+prompt_wav_modes = set()
 max_val = 0.8
 
 
+# NOTE locale is set once at startup, before the first lookup
+@functools.lru_cache(maxsize=512)
+def _t(key):
+    return i18n.t(key)
+
+
 def initialize_global_texts():
     global inference_mode_list, instruct_dict, stream_mode_list
-
-    inference_mode_list = [
-        i18n.t("inference_mode_list.pretrained_voice"),
-        i18n.t("inference_mode_list.3s_fast_replication"),
-        i18n.t("inference_mode_list.crosslingual"),
-        i18n.t("inference_mode_list.natural_language_control"),
-    ]
+    global sft_mode, zero_shot_mode, cross_lingual_mode, instruct_mode
+    global inference_dict, sft_spk_modes, prompt_wav_modes
+
+    sft_mode = _t("inference_mode_list.pretrained_voice")
+    zero_shot_mode = _t("inference_mode_list.3s_fast_replication")
+    cross_lingual_mode = _t("inference_mode_list.crosslingual")
+    instruct_mode = _t("inference_mode_list.natural_language_control")
+    inference_mode_list = [sft_mode, zero_shot_mode, cross_lingual_mode, instruct_mode]
     instruct_dict = {
-        i18n.t("inference_mode_list.pretrained_voice"): i18n.t(
-            "instruct_dict.pretrained_voice"
-        ),
-        i18n.t("inference_mode_list.3s_fast_replication"): i18n.t(
-            "instruct_dict.3s_fast_replication"
-        ),
-        i18n.t("inference_mode_list.crosslingual"): i18n.t(
-            "instruct_dict.crosslingual"
-        ),
-        i18n.t("inference_mode_list.natural_language_control"): i18n.t(
-            "instruct_dict.natural_language_control"
-        ),
+        sft_mode: _t("instruct_dict.pretrained_voice"),
+        zero_shot_mode: _t("instruct_dict.3s_fast_replication"),
+        cross_lingual_mode: _t("instruct_dict.crosslingual"),
+        instruct_mode: _t("instruct_dict.natural_language_control"),
     }
     stream_mode_list = [
-        (i18n.t("boolean.false"), False),
-        (i18n.t("boolean.true"), True),
+        (_t("boolean.false"), False),
+        (_t("boolean.true"), True),
     ]
+    inference_dict = {
+        sft_mode: inference_sft,
+        zero_shot_mode: inference_zero_shot,
+        cross_lingual_mode: inference_cross_lingual,
+        instruct_mode: inference_instruct,
+    }
+    sft_spk_modes = {sft_mode, instruct_mode}
+    prompt_wav_modes = {zero_shot_mode, cross_lingual_mode}
+
+
+@contextmanager
+def inference_context(dtype=torch.bfloat16):
+    with torch.inference_mode(), torch.autocast(
+        "cuda", dtype=dtype, enabled=torch.cuda.is_available()
+    ):
+        yield
 
 
 def generate_seed():
@@ -76,31 +95,86 @@ def generate_seed():
     return {"__type__": "update", "value": seed}
 
 
+def _trim_db(x, top_db, frame, hop):
+    # same frames and threshold as librosa.effects.trim: centered rms frames,
+    # kept where 20 * log10(rms / max_rms) > -top_db
+    n = x.shape[0]
+    pad = frame // 2
+    if n + 2 * pad < frame:
+        return 0, 0
+    power = torch.nn.functional.pad(x.square(), (pad, pad)).unfold(0, frame, hop)
+    power_db = 10.0 * torch.log10(power.mean(dim=1).clamp(min=1e-10))
+    nonsilent = torch.nonzero(power_db > power_db.max() - top_db).flatten().tolist()
+    if len(nonsilent) == 0:
+        return 0, 0
+    return nonsilent[0] * hop, min(n, (nonsilent[-1] + 1) * hop)
+
+
 def postprocess(speech, top_db=60, hop_length=220, win_length=440):
-    speech, _ = librosa.effects.trim(
-        speech, top_db=top_db, frame_length=win_length, hop_length=hop_length
+    start, end = _trim_db(speech[0], top_db, win_length, hop_length)
+    speech = speech[:, start:end]
+    # normalize and append the trailing silence in one pass over the samples
+    n = speech.shape[1]
+    out = torch.empty(1, n + prompt_pad_len, dtype=speech.dtype, device=speech.device)
+    peak = speech.abs().max()
+    if peak > max_val:
+        torch.mul(speech, max_val / peak, out=out[:, :n])
+    else:
+        out[:, :n].copy_(speech)
+    out[:, n:].zero_()
+    return out
+
+
+@functools.lru_cache(maxsize=16)
+def _load_prompt_wav(prompt_wav, mtime, size, target_sr):
+    # decode once for both the sample rate check and the prompt speech
+    speech, sample_rate = torchaudio.load(prompt_wav, backend="soundfile")
+    if sample_rate < target_sr:
+        return sample_rate, None
+    # resample, trim and normalize on the frontend device, the frontend
+    # feature extractors expect the prompt back on cpu
+    speech = speech.mean(dim=0, keepdim=True).to(
+        cosyvoice.frontend.device, non_blocking=True
     )
-    if speech.abs().max() > max_val:
-        speech = speech / speech.abs().max() * max_val
-    speech = torch.concat(
-        [speech, torch.zeros(1, int(cosyvoice.sample_rate * 0.2))], dim=1
+    if sample_rate != target_sr:
+        speech = torchaudio.functional.resample(
+            speech, sample_rate, target_sr, lowpass_filter_width=6
+        )
+    return sample_rate, postprocess(speech).cpu()
+
+
+def load_prompt_wav(prompt_wav, target_sr):
+    # regenerating with the same prompt reuses the decoded, trimmed speech
+    return _load_prompt_wav(
+        prompt_wav, os.path.getmtime(prompt_wav), os.path.getsize(prompt_wav), target_sr
     )
-    return speech
 
 
 def change_instruction(mode_checkbox_group):
     return instruct_dict[mode_checkbox_group]
 
 
-def prompt_wav_recognition(prompt_wav):
-    if prompt_wav:
+def asr_generate(audio):
+    # keep asr kernels off the default stream, tts_stream has higher priority
+    with torch.cuda.stream(asr_stream), inference_context(torch.float16):
         res = asr_model.generate(
-            input=prompt_wav,
+            input=audio,
             language="auto",  # "zn", "en", "yue", "ja", "ko", "nospeech"
             use_itn=True,
         )
-        text = res[0]["text"].split("|>")[-1]
-        return text
+    return res[0]["text"].split("|>")[-1]
+
+
+@functools.lru_cache(maxsize=64)
+def _recognize_prompt_wav(prompt_wav, mtime, size):
+    return asr_generate(prompt_wav)
+
+
+def prompt_wav_recognition(prompt_wav):
+    if prompt_wav:
+        return _recognize_prompt_wav(
+            prompt_wav, os.path.getmtime(prompt_wav), os.path.getsize(prompt_wav)
+        )
 
 
 def generate_audio(
@@ -121,191 +195,236 @@ def generate_audio(
         prompt_wav = prompt_wav_record
     else:
         prompt_wav = None
+    prompt_speech_16k = None
     # if instruct mode, please make sure that model is iic/CosyVoice-300M-Instruct and not cross_lingual mode
-    if mode_checkbox_group in [i18n.t("inference_mode_list.natural_language_control")]:
+    if mode_checkbox_group == instruct_mode:
         if cosyvoice.instruct is False:
-            gr.Warning(i18n.t("warnings.nlp_model_warn").format(args.model_dir))
+            gr.Warning(_t("warnings.nlp_model_warn").format(args.model_dir))
             yield (cosyvoice.sample_rate, default_data)
+            return
         if instruct_text == "":
-            gr.Warning(i18n.t("warnings.instruct_text"))
+            gr.Warning(_t("warnings.instruct_text"))
             yield (cosyvoice.sample_rate, default_data)
+            return
         if prompt_wav is not None or prompt_text != "":
-            gr.Info(i18n.t("info.prompt_wav"))
+            gr.Info(_t("info.prompt_wav"))
     # if cross_lingual mode, please make sure that model is iic/CosyVoice-300M and tts_text prompt_text are different language
-    if mode_checkbox_group in [i18n.t("inference_mode_list.crosslingual")]:
+    if mode_checkbox_group == cross_lingual_mode:
         if cosyvoice.instruct is True:
             gr.Warning(
-                i18n.t("warnings.no_crosslingual_support").format(args.model_dir)
+                _t("warnings.no_crosslingual_support").format(args.model_dir)
             )
             yield (cosyvoice.sample_rate, default_data)
+            return
         if instruct_text != "":
-            gr.Info(i18n.t("warnings.crosslingual_instruct_ignored"))
+            gr.Info(_t("warnings.crosslingual_instruct_ignored"))
         if prompt_wav is None:
-            gr.Warning(i18n.t("warnings.crosslingual_prompt_audio_required"))
+            gr.Warning(_t("warnings.crosslingual_prompt_audio_required"))
             yield (cosyvoice.sample_rate, default_data)
-        gr.Info(i18n.t("info.crosslingual_language_reminder"))
+            return
+        gr.Info(_t("info.crosslingual_language_reminder"))
     # if in zero_shot cross_lingual, please make sure that prompt_text and prompt_wav meets requirements
-    if mode_checkbox_group in [
-        i18n.t("inference_mode_list.3s_fast_replication"),
-        i18n.t("inference_mode_list.crosslingual"),
-    ]:
+    if mode_checkbox_group in prompt_wav_modes:
         if prompt_wav is None:
-            gr.Warning(i18n.t("warnings.prompt_audio_empty"))
+            gr.Warning(_t("warnings.prompt_audio_empty"))
             yield (cosyvoice.sample_rate, default_data)
-        if torchaudio.info(prompt_wav).sample_rate < prompt_sr:
+            return
+        prompt_wav_sr, prompt_speech_16k = load_prompt_wav(prompt_wav, prompt_sr)
+        if prompt_wav_sr < prompt_sr:
             gr.Warning(
-                i18n.t("warnings.sample_rate_error").format(
-                    torchaudio.info(prompt_wav).sample_rate, prompt_sr
-                )
+                _t("warnings.sample_rate_error").format(prompt_wav_sr, prompt_sr)
             )
             yield (cosyvoice.sample_rate, default_data)
+            return
     # sft mode only use sft_dropdown
-    if mode_checkbox_group in [i18n.t("inference_mode_list.pretrained_voice")]:
+    if mode_checkbox_group == sft_mode:
         if instruct_text != "" or prompt_wav is not None or prompt_text != "":
-            gr.Info(i18n.t("info.pretrained_voice_warning"))
+            gr.Info(_t("info.pretrained_voice_warning"))
         if sft_dropdown == "":
-            gr.Warning(i18n.t("warnings.pretrained_model_empty"))
+            gr.Warning(_t("warnings.pretrained_model_empty"))
             yield (cosyvoice.sample_rate, default_data)
+            return
     # zero_shot mode only use prompt_wav prompt text
-    if mode_checkbox_group in [i18n.t("inference_mode_list.3s_fast_replication")]:
+    if mode_checkbox_group == zero_shot_mode:
         if prompt_text == "":
-            gr.Warning(i18n.t("warnings.prompt_text_empty"))
+            gr.Warning(_t("warnings.prompt_text_empty"))
             yield (cosyvoice.sample_rate, default_data)
+            return
         if instruct_text != "":
-            gr.Info(i18n.t("info.instruct_text_empty"))
-
-    if mode_checkbox_group == i18n.t("inference_mode_list.pretrained_voice"):
-        logging.info("get sft inference request")
-        set_all_random_seed(seed)
-        for i in cosyvoice.inference_sft(
-            tts_text, sft_dropdown, stream=stream, speed=speed
-        ):
-            yield (cosyvoice.sample_rate, i["tts_speech"].numpy().flatten())
-    elif mode_checkbox_group == i18n.t("inference_mode_list.3s_fast_replication"):
-        logging.info("get zero_shot inference request")
-        prompt_speech_16k = postprocess(load_wav(prompt_wav, prompt_sr))
-        set_all_random_seed(seed)
-        for i in cosyvoice.inference_zero_shot(
-            tts_text, prompt_text, prompt_speech_16k, stream=stream, speed=speed
-        ):
-            yield (cosyvoice.sample_rate, i["tts_speech"].numpy().flatten())
-    elif mode_checkbox_group == i18n.t("inference_mode_list.crosslingual"):
-        logging.info("get cross_lingual inference request")
-        prompt_speech_16k = postprocess(load_wav(prompt_wav, prompt_sr))
-        set_all_random_seed(seed)
-        for i in cosyvoice.inference_cross_lingual(
-            tts_text, prompt_speech_16k, stream=stream, speed=speed
-        ):
-            yield (cosyvoice.sample_rate, i["tts_speech"].numpy().flatten())
-    else:
-        logging.info("get instruct inference request")
-        set_all_random_seed(seed)
-        for i in cosyvoice.inference_instruct(
-            tts_text, sft_dropdown, instruct_text, stream=stream, speed=speed
-        ):
-            yield (cosyvoice.sample_rate, i["tts_speech"].numpy().flatten())
+            gr.Info(_t("info.instruct_text_empty"))
+
+    set_all_random_seed(seed)
+    model_output = inference_dict[mode_checkbox_group](
+        tts_text, sft_dropdown, prompt_text, prompt_speech_16k, instruct_text, stream, speed
+    )
+    while True:
+        # gradio may resume this generator on another worker thread, and the
+        # current stream is per thread, so enter tts_stream for every step
+        with torch.cuda.stream(tts_stream):
+            i = next(model_output, None)
+        if i is None:
+            break
+        yield (cosyvoice.sample_rate, i["tts_speech"].reshape(-1).numpy())
+
+
+def inference_sft(
+    tts_text, sft_dropdown, prompt_text, prompt_speech_16k, instruct_text, stream, speed
+):
+    logging.info("get sft inference request")
+    return cosyvoice.inference_sft(tts_text, sft_dropdown, stream=stream, speed=speed)
+
+
+def inference_zero_shot(
+    tts_text, sft_dropdown, prompt_text, prompt_speech_16k, instruct_text, stream, speed
+):
+    logging.info("get zero_shot inference request")
+    return cosyvoice.inference_zero_shot(
+        tts_text, prompt_text, prompt_speech_16k, stream=stream, speed=speed
+    )
+
+
+def inference_cross_lingual(
+    tts_text, sft_dropdown, prompt_text, prompt_speech_16k, instruct_text, stream, speed
+):
+    logging.info("get cross_lingual inference request")
+    return cosyvoice.inference_cross_lingual(
+        tts_text, prompt_speech_16k, stream=stream, speed=speed
+    )
+
+
+def inference_instruct(
+    tts_text, sft_dropdown, prompt_text, prompt_speech_16k, instruct_text, stream, speed
+):
+    logging.info("get instruct inference request")
+    return cosyvoice.inference_instruct(
+        tts_text, sft_dropdown, instruct_text, stream=stream, speed=speed
+    )
+
+
+def load_asr_model(model_dir, device):
+    # funasr is only needed here, import it on the loader thread
+    from funasr import AutoModel
+
+    return AutoModel(
+        model=model_dir, disable_update=True, log_level="DEBUG", device=device
+    )
+
+
+def compile_models():
+    # let dynamo fall back to eager for graphs it can not capture
+    torch._dynamo.config.suppress_errors = True
+    model = cosyvoice.model
+    if isinstance(model.flow.decoder.estimator, torch.nn.Module):
+        model.flow.decoder.estimator = torch.compile(
+            model.flow.decoder.estimator, dynamic=True
+        )
+    # CosyVoice decodes with forward_chunk, CosyVoice2 with forward_one_step
+    for name in ["forward_chunk", "forward_one_step"]:
+        if hasattr(model.llm.llm, name):
+            setattr(
+                model.llm.llm,
+                name,
+                torch.compile(getattr(model.llm.llm, name), dynamic=True),
+            )
+    model.hift.decode = torch.compile(model.hift.decode, dynamic=True)
+    if hasattr(asr_model.model, "encoder"):
+        asr_model.model.encoder = torch.compile(asr_model.model.encoder, dynamic=True)
+
+
+def warmup(n=2):
+    if sft_spk[0] == "":
+        _, prompt_speech_16k = load_prompt_wav(
+            "{}/asset/zero_shot_prompt.wav".format(ROOT_DIR), prompt_sr
+        )
+    for _ in range(n):
+        with torch.cuda.stream(tts_stream), torch.inference_mode():
+            if sft_spk[0] != "":
+                list(cosyvoice.inference_sft("warmup", sft_spk[0], stream=False, speed=1.0))
+            else:
+                list(
+                    cosyvoice.inference_cross_lingual(
+                        "warmup", prompt_speech_16k, stream=False, speed=1.0
+                    )
+                )
+    asr_generate(np.zeros(prompt_sr, dtype=np.float32))
 
 
 def main():
     with gr.Blocks() as demo:
-        gr.Markdown(i18n.t("markdown.code_reference"))
-        gr.Markdown(i18n.t("markdown.output_text_prompt"))
+        gr.Markdown(_t("markdown.code_reference"))
+        gr.Markdown(_t("markdown.output_text_prompt"))
 
         tts_text = gr.Textbox(
-            label=i18n.t("input_label.enter_synthesis_text"),
+            label=_t("input_label.enter_synthesis_text"),
             lines=1,
-            value=i18n.t("placeholders.enter_synthesis_text"),
+            value=_t("placeholders.enter_synthesis_text"),
         )
         with gr.Row():
             mode_checkbox_group = gr.Radio(
                 choices=inference_mode_list,
-                label=i18n.t("input_label.select_inference_mode_radio"),
+                label=_t("input_label.select_inference_mode_radio"),
                 value=inference_mode_list[0],
             )
-            with gr.Accordion(i18n.t("input_label.instruction_text")):
+            with gr.Accordion(_t("input_label.instruction_text")):
                 instruction_text = gr.Markdown(
-                    label=i18n.t("input_label.instruction_text"),
+                    label=_t("input_label.instruction_text"),
                     value=instruct_dict[inference_mode_list[0]],
                 )
         with gr.Row():
             sft_dropdown = gr.Dropdown(
                 choices=sft_spk,
-                label=i18n.t("input_label.sft_dropdown"),
+                label=_t("input_label.sft_dropdown"),
                 value=sft_spk[0],
                 scale=0.25,
-                visible=(
-                    mode_checkbox_group.value
-                    in [
-                        i18n.t("inference_mode_list.pretrained_voice"),
-                        i18n.t("inference_mode_list.natural_language_control"),
-                    ]
-                ),
+                visible=(mode_checkbox_group.value in sft_spk_modes),
             )
             stream = gr.Radio(
                 choices=stream_mode_list,
-                label=i18n.t("input_label.stream"),
+                label=_t("input_label.stream"),
                 value=stream_mode_list[0][1],
             )
             speed = gr.Number(
                 value=1,
-                label=i18n.t("input_label.speed_adjustment"),
+                label=_t("input_label.speed_adjustment"),
                 minimum=0.5,
                 maximum=2.0,
                 step=0.1,
             )
             with gr.Column(scale=0.25):
                 seed_button = gr.Button(value="\U0001F3B2")
-                seed = gr.Number(value=0, label=i18n.t("input_label.seed_number"))
+                seed = gr.Number(value=0, label=_t("input_label.seed_number"))
 
         with gr.Row():
             prompt_wav_upload = gr.Audio(
                 sources="upload",
                 type="filepath",
-                label=i18n.t("input_label.prompt_wav_upload"),
-                visible=(
-                    mode_checkbox_group.value
-                    in [
-                        i18n.t("inference_mode_list.3s_fast_replication"),
-                        i18n.t("inference_mode_list.crosslingual"),
-                    ]
-                ),
+                label=_t("input_label.prompt_wav_upload"),
+                visible=(mode_checkbox_group.value in prompt_wav_modes),
             )
             prompt_wav_record = gr.Audio(
                 sources="microphone",
                 type="filepath",
-                label=i18n.t("input_label.prompt_wav_record"),
-                visible=(
-                    mode_checkbox_group.value
-                    in [
-                        i18n.t("inference_mode_list.3s_fast_replication"),
-                        i18n.t("inference_mode_list.crosslingual"),
-                    ]
-                ),
+                label=_t("input_label.prompt_wav_record"),
+                visible=(mode_checkbox_group.value in prompt_wav_modes),
             )
             prompt_text = gr.Textbox(
-                label=i18n.t("input_label.prompt_text"),
+                label=_t("input_label.prompt_text"),
                 lines=3,
-                placeholder=i18n.t("placeholders.prompt_text"),
+                placeholder=_t("placeholders.prompt_text"),
                 value="",
-                visible=(
-                    mode_checkbox_group.value
-                    in [
-                        i18n.t("inference_mode_list.3s_fast_replication"),
-                        i18n.t("inference_mode_list.crosslingual"),
-                    ]
-                ),
+                visible=(mode_checkbox_group.value in prompt_wav_modes),
             )
             instruct_text = gr.Textbox(
-                label=i18n.t("input_label.instruct_text"),
+                label=_t("input_label.instruct_text"),
                 lines=3,
-                placeholder=i18n.t("placeholders.instruct_text"),
+                placeholder=_t("placeholders.instruct_text"),
                 value="",
             )
 
-        generate_button = gr.Button(i18n.t("input_label.generate_button"))
+        generate_button = gr.Button(_t("input_label.generate_button"))
 
         audio_output = gr.Audio(
-            label=i18n.t("input_label.audio_output"), autoplay=True, streaming=True
+            label=_t("input_label.audio_output"), autoplay=True, streaming=True
         )
 
         seed_button.click(generate_seed, inputs=[], outputs=seed)
@@ -324,62 +443,43 @@ def main():
                 speed,
             ],
             outputs=[audio_output],
+            concurrency_limit=4,
+            concurrency_id="tts",
         )
         mode_checkbox_group.change(
             fn=change_instruction,
             inputs=[mode_checkbox_group],
             outputs=[instruction_text],
         )
+        # sft_dropdown, prompt_wav_upload, prompt_wav_record, prompt_text
+        visibility_dict = {
+            mode: (mode in sft_spk_modes,) + (mode in prompt_wav_modes,) * 3
+            for mode in inference_mode_list
+        }
         mode_checkbox_group.change(
-            fn=lambda mode: (
-                gr.update(
-                    visible=(
-                        mode
-                        in [
-                            i18n.t("inference_mode_list.pretrained_voice"),
-                            i18n.t("inference_mode_list.natural_language_control"),
-                        ]
-                    )
-                ),
-                gr.update(
-                    visible=(
-                        mode
-                        in [
-                            i18n.t("inference_mode_list.3s_fast_replication"),
-                            i18n.t("inference_mode_list.crosslingual"),
-                        ]
-                    )
-                ),
-                gr.update(
-                    visible=(
-                        mode
-                        in [
-                            i18n.t("inference_mode_list.3s_fast_replication"),
-                            i18n.t("inference_mode_list.crosslingual"),
-                        ]
-                    )
-                ),
-                gr.update(
-                    visible=(
-                        mode
-                        in [
-                            i18n.t("inference_mode_list.3s_fast_replication"),
-                            i18n.t("inference_mode_list.crosslingual"),
-                        ]
-                    )
-                ),
-            ),
+            fn=lambda mode: tuple(gr.update(visible=v) for v in visibility_dict[mode]),
             inputs=[mode_checkbox_group],
             outputs=[sft_dropdown, prompt_wav_upload, prompt_wav_record, prompt_text],
         )
         prompt_wav_upload.change(
-            fn=prompt_wav_recognition, inputs=[prompt_wav_upload], outputs=[prompt_text]
+            fn=prompt_wav_recognition,
+            inputs=[prompt_wav_upload],
+            outputs=[prompt_text],
+            concurrency_limit=8,
+            concurrency_id="asr",
         )
         prompt_wav_record.change(
-            fn=prompt_wav_recognition, inputs=[prompt_wav_record], outputs=[prompt_text]
+            fn=prompt_wav_recognition,
+            inputs=[prompt_wav_record],
+            outputs=[prompt_text],
+            concurrency_limit=8,
+            concurrency_id="asr",
         )
 
-    demo.queue(max_size=4, default_concurrency_limit=2)
+    # CosyVoiceModel keeps per-request state keyed by uuid and runs each llm job
+    # in its own thread, so concurrent requests interleave on the gpu; tts and
+    # asr events get separate concurrency groups so asr never waits behind tts
+    demo.queue(max_size=32, default_concurrency_limit=8)
     demo.launch(server_name="0.0.0.0", server_port=args.port)
 
 
@@ -393,28 +493,53 @@ if __name__ == "__main__":
         help="local path or modelscope repo id",
     )
     parser.add_argument("--locale", type=str, default="en", help="language locale")
+    parser.add_argument(
+        "--fp16", action="store_true", help="run the llm and flow in fp16"
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="torch.compile the hot inference modules"
+    )
     args = parser.parse_args()
 
     i18n.set("locale", args.locale)
     initialize_global_texts()
 
-    try:
-        cosyvoice = CosyVoice(args.model_dir)
-    except Exception:
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+    asr_model_dir = "pretrained_models/SenseVoiceSmall"
+    # serve asr from a second gpu when there is one
+    asr_device = "cuda:1" if torch.cuda.device_count() > 1 else "cuda"
+    # load the asr model while the tts model is being built
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asr_model_future = executor.submit(load_asr_model, asr_model_dir, asr_device)
         try:
-            cosyvoice = CosyVoice2(args.model_dir)
+            cosyvoice = CosyVoice(args.model_dir, fp16=args.fp16)
         except Exception:
-            raise TypeError("no valid model_type!")
+            try:
+                cosyvoice = CosyVoice2(args.model_dir, fp16=args.fp16)
+            except Exception:
+                raise TypeError("no valid model_type!")
+        asr_model = asr_model_future.result()
 
     sft_spk = cosyvoice.list_available_spks()
     if len(sft_spk) == 0:
         sft_spk = [""]
 
     prompt_sr = 16000
-    default_data = np.zeros(cosyvoice.sample_rate)
-
-    asr_model_dir = "pretrained_models/SenseVoiceSmall"
-    asr_model = AutoModel(
-        model=asr_model_dir, disable_update=True, log_level="DEBUG", device="cuda"
-    )
+    prompt_pad_len = int(cosyvoice.sample_rate * 0.2)
+    # shared by every warning branch, so keep it float32 like the model output
+    # and read-only
+    default_data = np.zeros(cosyvoice.sample_rate, dtype=np.float32)
+    default_data.setflags(write=False)
+
+    if torch.cuda.is_available():
+        # lower number is higher priority, 0 is the lowest
+        tts_stream = torch.cuda.Stream(priority=-1)
+        asr_stream = torch.cuda.Stream(device=asr_device, priority=0)
+    else:
+        tts_stream = asr_stream = None
+    if args.compile:
+        compile_models()
+    # pay kernel loading (and compilation) before the first user request
+    warmup()
     main()